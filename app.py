@@ -2,12 +2,21 @@ import sqlite3
 
 import streamlit as st
 
-from services import create_expenses_table, seed_expenses_table
+from services import WRITE_LOCK, create_expenses_table, seed_expenses_table
 from views import render_create, render_delete, render_read, render_update
 
 CHAR_LIMIT = 140
 DATABASE_URI = "expenses.db"
 # DATABASE_URI = ":memory:"
+CONNECTION_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-64000",
+    "mmap_size=134217728",
+)
+# Hot ExpenseService queries use fixed SQL text, so they all stay in sqlite3's statement cache
+CACHED_STATEMENTS = 256
 
 
 def main() -> None:
@@ -33,25 +42,36 @@ def render_sidebar(connection: sqlite3.Connection) -> None:
     render_func(connection)
 
 
-@st.cache(hash_funcs={sqlite3.Connection: id}, suppress_st_warning=True)
+@st.cache_resource(show_spinner=False)
 def get_connection(connection_string: str = ":memory:") -> sqlite3.Connection:
     """Make a connection object to sqlite3 with key-value Rows as outputs
     Threading in Streamlit / Python with sqlite:
     - https://discuss.streamlit.io/t/prediction-analysis-and-creating-a-database/3504/2
     - https://stackoverflow.com/questions/48218065/programmingerror-sqlite-objects-created-in-a-thread-can-only-be-used-in-that-sa
+    WAL journaling with synchronous=NORMAL avoids an fsync per commit and lets reads run alongside writes:
+    - https://www.sqlite.org/wal.html
     """
-    st.error("Get Connection")
-    connection = sqlite3.connect(connection_string, check_same_thread=False)
+    connection = sqlite3.connect(
+        connection_string, check_same_thread=False, cached_statements=CACHED_STATEMENTS
+    )
     connection.row_factory = sqlite3.Row
+    # Autocommit mode; writes open their own BEGIN IMMEDIATE transaction in execute_write
+    connection.isolation_level = None
+    for pragma in CONNECTION_PRAGMAS:
+        connection.execute(f"PRAGMA {pragma}")
     return connection
 
 
-@st.cache(hash_funcs={sqlite3.Connection: id}, suppress_st_warning=True)
-def init_db(connection: sqlite3.Connection) -> None:
-    """Create table and seed data as needed for initialization"""
+@st.cache_resource(show_spinner=False)
+def init_db(_connection: sqlite3.Connection) -> None:
+    """Create table and seed data as needed for initialization, all in one transaction"""
     st.warning("Init DB")
-    create_expenses_table(connection)
-    seed_expenses_table(connection)
+    with WRITE_LOCK, _connection:
+        _connection.execute("BEGIN IMMEDIATE")
+        create_expenses_table(_connection)
+        seed_expenses_table(_connection)
+        # Give the query planner row statistics for choosing between the indexes
+        _connection.execute("ANALYZE")
 
 
 if __name__ == "__main__":
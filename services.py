@@ -1,117 +1,311 @@
 from datetime import date
-import random
+import json
 import sqlite3
-from typing import Optional, List
+import threading
+from typing import Optional, List, Tuple
+
+import numpy as np
+import pandas as pd
 import streamlit as st
 
 from models import Expense, BaseExpense
 
-
-def create_expenses_table(connection: sqlite3.Connection) -> None:
-    """Create Expenses Table in the database if it doesn't already exist"""
-    st.warning("Creating Expenses Table")
-    init_expenses_query = f"""CREATE TABLE IF NOT EXISTS expenses(
+# Every session shares one cached connection, and SQLite's write lock only separates connections,
+# so writers on that connection take turns here instead of nesting BEGINs
+WRITE_LOCK = threading.Lock()
+EXPENSE_COLUMNS = ("rowid", "purchased_date", "purchased_by", "price_in_cents", "comment")
+SEED_PURCHASERS = ["Alice", "Bob", "Chuck"]
+SEED_COMMENTS = ['Computer Parts 💻', 'Neatflicks Subscription 🍿', 'Food 🍜', '"Food" 🍻']
+EXPENSES_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS expenses(
    purchased_date VARCHAR(10) NOT NULL,
    purchased_by VARCHAR(120) NOT NULL,
    comment VARCHAR(120),
-   price_in_cents INT NOT NULL);"""
-    execute_query(connection, init_expenses_query)
+   price_in_cents INT NOT NULL);""",
+    # Covers date range filters and ORDER BY purchased_date DESC without a sort or table lookup
+    """CREATE INDEX IF NOT EXISTS idx_expenses_date
+   ON expenses(purchased_date DESC, purchased_by, price_in_cents);""",
+    # Lets DISTINCT purchased_by and purchaser-only filters read the index instead of the table
+    """CREATE INDEX IF NOT EXISTS idx_expenses_by ON expenses(purchased_by);""",
+    # Shadow roster of purchaser names kept in step by triggers, so listing them skips the expenses table
+    """CREATE TABLE IF NOT EXISTS purchasers(name VARCHAR(120) PRIMARY KEY) WITHOUT ROWID;""",
+    """CREATE TRIGGER IF NOT EXISTS expenses_ai AFTER INSERT ON expenses BEGIN
+   INSERT OR IGNORE INTO purchasers(name) VALUES(NEW.purchased_by);
+   END;""",
+    """CREATE TRIGGER IF NOT EXISTS expenses_au AFTER UPDATE OF purchased_by ON expenses BEGIN
+   INSERT OR IGNORE INTO purchasers(name) VALUES(NEW.purchased_by);
+   DELETE FROM purchasers WHERE name = OLD.purchased_by
+      AND NOT EXISTS (SELECT 1 FROM expenses WHERE purchased_by = OLD.purchased_by);
+   END;""",
+    """CREATE TRIGGER IF NOT EXISTS expenses_ad AFTER DELETE ON expenses BEGIN
+   DELETE FROM purchasers WHERE name = OLD.purchased_by
+      AND NOT EXISTS (SELECT 1 FROM expenses WHERE purchased_by = OLD.purchased_by);
+   END;""",
+    # Backfill for databases created before the roster existed
+    """INSERT OR IGNORE INTO purchasers(name) SELECT DISTINCT purchased_by FROM expenses;""",
+)
+
+# Fixed query text, built once, so sqlite3's statement cache reuses the compiled statements
+SELECT_EXPENSES = f"SELECT {', '.join(EXPENSE_COLUMNS)} FROM expenses"
+GET_EXPENSE_QUERY = f"{SELECT_EXPENSES} WHERE rowid = :rowid;"
+LIST_PURCHASERS_QUERY = "SELECT name FROM purchasers ORDER BY name;"
+LIST_EXPENSE_LABELS_QUERY = "SELECT rowid, purchased_date, purchased_by, comment FROM expenses ORDER BY purchased_date DESC;"
+TABLE_VERSION_QUERY = "SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM expenses;"
+# One canonical filter for every date range / purchaser combination, so the SQL text never varies
+EXPENSES_FILTER = """WHERE purchased_date BETWEEN :start_date AND :end_date
+    AND (:selections IS NULL OR purchased_by IN (SELECT value FROM json_each(:selections)))"""
+LIST_EXPENSES_QUERY = f"{SELECT_EXPENSES} {EXPENSES_FILTER} ORDER BY purchased_date DESC;"
+# rowid breaks purchase date ties so consecutive pages never overlap
+LIST_EXPENSES_PAGE_QUERY = (
+    f"{SELECT_EXPENSES} ORDER BY purchased_date DESC, rowid DESC LIMIT :limit OFFSET :offset;"
+)
+CREATE_EXPENSE_QUERY = """INSERT into expenses(purchased_date, purchased_by, price_in_cents, comment)
+    VALUES(:purchased_date, :purchased_by, :price_in_cents, :comment);"""
+UPDATE_EXPENSE_QUERY = """UPDATE expenses SET purchased_date=:purchased_date, purchased_by=:purchased_by, price_in_cents=:price_in_cents, comment=:comment WHERE rowid=:rowid;"""
+DELETE_EXPENSE_QUERY = """DELETE from expenses WHERE rowid = :rowid;"""
+
+
+def create_expenses_table(connection: sqlite3.Connection) -> None:
+    """Create Expenses Table and its indexes in the database if they don't already exist.
+    Doesn't commit, so it can share the caller's transaction"""
+    st.warning("Creating Expenses Table")
+    for statement in EXPENSES_SCHEMA:
+        connection.execute(statement)
 
 
 def seed_expenses_table(connection: sqlite3.Connection) -> None:
-    """Insert a sample Expense row into the database"""
+    """Insert sample Expense rows into the database with a single statement.
+    Skipped when the table already has data, so restarts don't re-seed.
+    Doesn't commit, so it can share the caller's transaction"""
+    if execute_read(connection, "SELECT 1 FROM expenses LIMIT 1"):
+        return
     st.warning("Seeding Expenses Table")
 
-    for i in range(200):
-        seed_expense = Expense(
-            rowid=i,
-            purchased_date=date(
-                random.randint(2020, 2022), random.randint(1, 12), random.randint(1, 28)
-            ).strftime("%Y-%m-%d"),
-            purchased_by=random.choice(["Alice", "Bob", "Chuck"]),
-            comment=random.choice(('Computer Parts 💻', 'Neatflicks Subscription 🍿', 'Food 🍜', '"Food" 🍻')),
-            price_in_cents=random.randint(50, 100_00),
+    n_seed = 200
+    rng = np.random.default_rng()
+    purchased_dates = pd.to_datetime(
+        pd.DataFrame(
+            {
+                "year": rng.integers(2020, 2022, n_seed, endpoint=True),
+                "month": rng.integers(1, 12, n_seed, endpoint=True),
+                "day": rng.integers(1, 28, n_seed, endpoint=True),
+            }
         )
-        seed_expense_query = f"""REPLACE into expenses(rowid, purchased_date, purchased_by, price_in_cents, comment)
-        VALUES(:rowid, :purchased_date, :purchased_by, :price_in_cents, :comment);"""
-        execute_query(connection, seed_expense_query, seed_expense.dict())
+    )
+    seed_df = pd.DataFrame(
+        {
+            "rowid": np.arange(n_seed),
+            "purchased_date": purchased_dates.dt.strftime("%Y-%m-%d"),
+            "purchased_by": rng.choice(SEED_PURCHASERS, n_seed),
+            "comment": rng.choice(SEED_COMMENTS, n_seed),
+            "price_in_cents": rng.integers(50, 100_00, n_seed, endpoint=True),
+        }
+    )
+    seed_expense_query = """REPLACE into expenses(rowid, purchased_date, purchased_by, price_in_cents, comment)
+        SELECT json_extract(value, '$.rowid'), json_extract(value, '$.purchased_date'),
+        json_extract(value, '$.purchased_by'), json_extract(value, '$.price_in_cents'),
+        json_extract(value, '$.comment')
+        FROM json_each(:seed_expenses);"""
+    # One statement unpacking a JSON array instead of one execution per inserted row
+    connection.execute(
+        seed_expense_query, {"seed_expenses": seed_df.to_json(orient="records")}
+    )
 
 
-def execute_query(
-    connection: sqlite3.Connection, query: str, args: Optional[dict] = None
+def execute_read(
+    connection: sqlite3.Connection,
+    query: str,
+    args: Optional[dict] = None,
+    as_tuples: bool = False,
 ) -> list:
     """Given sqlite3.Connection and a string query (and optionally necessary query args as a dict),
-    Attempt to execute query with cursor, commit transaction, and return fetched rows"""
-    cur = connection.cursor()
-    if args is not None:
-        cur.execute(query, args)
-    else:
-        cur.execute(query)
-    connection.commit()
-    results = cur.fetchall()
-    cur.close()
-    return results
+    Attempt to execute read-only query with cursor and return fetched rows. No commit is issued
+    as_tuples skips the connection's sqlite3.Row factory for cheaper plain tuple rows"""
+    cur = connection.execute(query, args or {})
+    if as_tuples:
+        cur.row_factory = None
+    return cur.fetchall()
+
+
+def execute_write(
+    connection: sqlite3.Connection,
+    query: str,
+    args: Optional[dict] = None,
+    fetch: bool = False,
+) -> list:
+    """Given sqlite3.Connection and a string query (and optionally necessary query args as a dict),
+    Attempt to execute query inside a transaction and commit once.
+    Fetched rows are only returned with fetch=True (e.g. for RETURNING), plain writes skip fetchall.
+    WRITE_LOCK serializes writers sharing this connection, so one session's BEGIN never lands inside another's
+    open transaction. BEGIN IMMEDIATE then takes SQLite's write lock up front against other connections"""
+    with WRITE_LOCK, connection:
+        connection.execute("BEGIN IMMEDIATE")
+        cur = connection.execute(query, args or {})
+        return cur.fetchall() if fetch else []
+
+
+def build_expenses_filter_args(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    selections: Optional[list[str]] = None,
+) -> dict:
+    """Build the named query args for EXPENSES_FILTER.
+    Missing date bounds bind sentinels that match every row, no selections binds NULL to skip the purchaser filter"""
+    return {
+        "start_date": start_date if start_date is not None else "0000-01-01",
+        "end_date": end_date if end_date is not None else "9999-12-31",
+        "selections": json.dumps(selections) if selections is not None else None,
+    }
+
+
+def build_spending_args(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    selections: Optional[list[str]] = None,
+) -> dict:
+    """Build the named query args for the per person spending queries.
+    Including "All" in selections sets include_all for a combined purchaser; selecting only "All" clears per_person"""
+    only_all = selections is not None and list(selections) == ["All"]
+    kwargs = build_expenses_filter_args(
+        start_date, end_date, None if only_all else selections
+    )
+    kwargs["per_person"] = not only_all
+    kwargs["include_all"] = selections is not None and "All" in selections
+    return kwargs
 
 
 class ExpenseService:
     """Namespace for Database Related Expense Operations"""
 
-    def list_all_purchasers(connection: sqlite3.Connection) -> List[str]:
-        select_purchasers = "SELECT DISTINCT purchased_by FROM expenses"
-        expense_rows = execute_query(connection, select_purchasers)
-        return [x["purchased_by"] for x in expense_rows]
+    @st.cache_data(ttl=60, show_spinner=False, max_entries=1)
+    def list_all_purchasers(
+        _connection: sqlite3.Connection, table_version: Tuple[int, int]
+    ) -> List[str]:
+        """Returns each distinct purchaser name from the trigger maintained purchasers table.
+        Cached on `table_version`, call `ExpenseService.list_all_purchasers.clear()` after writes"""
+        expense_rows = execute_read(_connection, LIST_PURCHASERS_QUERY, as_tuples=True)
+        return [purchased_by for (purchased_by,) in expense_rows]
+
+    def get_table_version(connection: sqlite3.Connection) -> Tuple[int, int]:
+        """Returns a cheap (row count, max rowid) digest of the expenses table, for cache keys"""
+        (version,) = execute_read(connection, TABLE_VERSION_QUERY, as_tuples=True)
+        return version
 
-    def list_all_expenses(
+    @st.cache_data(show_spinner=False, max_entries=1)
+    def list_expense_labels(
+        _connection: sqlite3.Connection, table_version: Tuple[int, int]
+    ) -> List[Tuple[int, str]]:
+        """Returns (rowid, display label) pairs for every expense. Ordered newest purchase date first
+        Cached on `table_version`, call `ExpenseService.list_expense_labels.clear()` after updates"""
+        expense_rows = execute_read(_connection, LIST_EXPENSE_LABELS_QUERY, as_tuples=True)
+        return [
+            (rowid, f"{rowid} {comment} - by {purchased_by} on {purchased_date}")
+            for rowid, purchased_date, purchased_by, comment in expense_rows
+        ]
+
+    def list_all_expenses_df(
+        connection: sqlite3.Connection,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        selections: Optional[list[str]] = None,
+    ) -> pd.DataFrame:
+        """Returns all expenses loaded straight into a DataFrame. Ordered newest purchase date first"""
+        kwargs = build_expenses_filter_args(start_date, end_date, selections)
+        return pd.read_sql_query(
+            LIST_EXPENSES_QUERY, connection, params=kwargs, parse_dates=["purchased_date"]
+        )
+
+    def list_expenses_page_df(
+        connection: sqlite3.Connection, offset: int, limit: int
+    ) -> pd.DataFrame:
+        """Returns one page of expenses loaded straight into a DataFrame.
+        Ordered newest purchase date first, with newer rowids first among expenses on the same date"""
+        return pd.read_sql_query(
+            LIST_EXPENSES_PAGE_QUERY,
+            connection,
+            params={"offset": offset, "limit": limit},
+            parse_dates=["purchased_date"],
+        )
+
+    def list_daily_window_totals_df(
         connection: sqlite3.Connection,
         start_date: Optional[date] = None,
         end_date: Optional[date] = None,
         selections: Optional[list[str]] = None,
-    ) -> List[sqlite3.Row]:
-        """Returns rows from all expenses. Ordered in reverse creation order"""
-        select = (
-            "SELECT rowid, purchased_date, purchased_by, price_in_cents, comment FROM expenses"
+    ) -> pd.DataFrame:
+        """Returns daily spend per purchaser over every day from start_date to end_date,
+        falling back to the first or last purchase for a missing bound,
+        with the running total, trailing 7 day sum, and trailing 30 day max computed by SQLite window functions.
+        Including "All" in selections adds a combined purchaser; selecting only "All" returns just that one.
+        Ordered by purchaser then purchase date"""
+        kwargs = build_spending_args(start_date, end_date, selections)
+        kwargs["grid_start"] = start_date
+        kwargs["grid_end"] = end_date
+        query = f"""WITH RECURSIVE filtered AS (
+            SELECT purchased_date, purchased_by, price_in_cents FROM expenses {EXPENSES_FILTER}
+        ), daily AS (
+            SELECT purchased_date, purchased_by, SUM(price_in_cents) AS price_in_cents
+            FROM filtered WHERE :per_person GROUP BY purchased_date, purchased_by
+            UNION ALL
+            SELECT purchased_date, 'All', SUM(price_in_cents)
+            FROM filtered WHERE :include_all GROUP BY purchased_date
+        ), days(purchased_date) AS (
+            SELECT COALESCE(:grid_start, MIN(purchased_date)) FROM daily
+            UNION ALL
+            SELECT date(purchased_date, '+1 day') FROM days
+            WHERE purchased_date < COALESCE(:grid_end, (SELECT MAX(purchased_date) FROM daily))
+        ), grid AS (
+            SELECT days.purchased_date, people.purchased_by, COALESCE(daily.price_in_cents, 0) AS price_in_cents
+            FROM days
+            CROSS JOIN (SELECT DISTINCT purchased_by FROM daily) AS people
+            LEFT JOIN daily USING (purchased_date, purchased_by)
+            WHERE days.purchased_date IS NOT NULL
+        )
+        SELECT purchased_date, purchased_by, price_in_cents,
+            SUM(price_in_cents) OVER (person_days ROWS UNBOUNDED PRECEDING) AS cum_price_in_cents,
+            SUM(price_in_cents) OVER (person_days ROWS 6 PRECEDING) AS week_price_in_cents,
+            MAX(price_in_cents) OVER (person_days ROWS 29 PRECEDING) AS month_max_price_in_cents
+        FROM grid
+        WINDOW person_days AS (PARTITION BY purchased_by ORDER BY purchased_date)
+        ORDER BY purchased_by, purchased_date;"""
+        return pd.read_sql_query(
+            query, connection, params=kwargs, parse_dates=["purchased_date"]
         )
-        where = ""
-        do_and = False
-        kwargs = {}
-        if any(x is not None for x in (start_date, end_date, selections)):
-            where = "WHERE"
-        if start_date is not None:
-            where += " purchased_date >= :start_date"
-            kwargs["start_date"] = start_date
-            do_and = True
-        if end_date is not None:
-            if do_and:
-                where += " and"
-            where += " purchased_date <= :end_date"
-            kwargs["end_date"] = end_date
-            do_and = True
-        if selections is not None:
-            if do_and:
-                where += " and"
-            selection_map = {str(i): x for i, x in enumerate(selections)}
-            where += (
-                f" purchased_by IN ({','.join(':' + x for x in selection_map.keys())})"
-            )
-            kwargs.update(selection_map)
-
-        order_by = "ORDER BY purchased_date DESC;"
-        query = " ".join((select, where, order_by))
-        expense_rows = execute_query(connection, query, kwargs)
-        return expense_rows
+
+    def list_purchaser_totals_df(
+        connection: sqlite3.Connection,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        selections: Optional[list[str]] = None,
+    ) -> pd.DataFrame:
+        """Returns total dollars spent per purchaser, summed by SQLite so only one row per person is fetched.
+        Selections behave as in `list_daily_window_totals_df`. Ordered by purchaser"""
+        kwargs = build_spending_args(start_date, end_date, selections)
+        query = f"""WITH filtered AS (
+            SELECT purchased_by, price_in_cents FROM expenses {EXPENSES_FILTER}
+        )
+        SELECT purchased_by, SUM(price_in_cents) / 100.0 AS value
+        FROM filtered WHERE :per_person GROUP BY purchased_by
+        UNION ALL
+        SELECT * FROM (
+            SELECT 'All', SUM(price_in_cents) / 100.0 AS value FROM filtered WHERE :include_all
+        ) WHERE value IS NOT NULL
+        ORDER BY purchased_by;"""
+        return pd.read_sql_query(query, connection, params=kwargs)
+
+    def get_expense(connection: sqlite3.Connection, rowid: int) -> Optional[Expense]:
+        """Returns the single Expense with the given rowid, if it exists"""
+        expense_rows = execute_read(connection, GET_EXPENSE_QUERY, {"rowid": rowid})
+        return Expense(**expense_rows[0]) if expense_rows else None
 
     def create_expense(connection: sqlite3.Connection, expense: BaseExpense) -> None:
         """Create a Expense in the database"""
-        create_expense_query = f"""INSERT into expenses(purchased_date, purchased_by, price_in_cents, comment)
-    VALUES(:purchased_date, :purchased_by, :price_in_cents, :comment);"""
-        execute_query(connection, create_expense_query, expense.dict())
+        execute_write(connection, CREATE_EXPENSE_QUERY, expense.dict())
 
     def update_expense(connection: sqlite3.Connection, expense: Expense) -> None:
         """Replace a Expense in the database"""
-        update_expense_query = f"""UPDATE expenses SET purchased_date=:purchased_date, purchased_by=:purchased_by, price_in_cents=:price_in_cents, comment=:comment WHERE rowid=:rowid;"""
-        execute_query(connection, update_expense_query, expense.dict())
+        execute_write(connection, UPDATE_EXPENSE_QUERY, expense.dict())
 
     def delete_expense(connection: sqlite3.Connection, expense: Expense) -> None:
         """Delete a Expense in the database"""
-        delete_expense_query = f"""DELETE from expenses WHERE rowid = :rowid;"""
-        execute_query(connection, delete_expense_query, {"rowid": expense.rowid})
+        execute_write(connection, DELETE_EXPENSE_QUERY, {"rowid": expense.rowid})
@@ -1,14 +1,22 @@
+import contextlib
 from datetime import date, datetime, timedelta, timezone
+import os
 import sqlite3
+import time
+from typing import Optional, Tuple
 
 from models import Expense, BaseExpense
 from services import ExpenseService
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 import streamlit_pydantic as sp
-import plotly.graph_objects as go
 import plotly.express as px
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+FEED_PAGE_SIZE = 50
 
 
 def display_timestamp(timestamp: int) -> datetime:
@@ -18,20 +26,39 @@ def display_timestamp(timestamp: int) -> datetime:
 
 def utc_timestamp() -> int:
     """Return current utc timestamp rounded to nearest int"""
-    return int(datetime.utcnow().timestamp())
+    return int(time.time())
 
 
 def render_expense(expense: Expense) -> None:
     """Show a expense with streamlit display functions"""
-    st.subheader(f"{expense.comment} By {expense.purchased_by} at {expense.purchased_date}")
+    st.subheader(
+        f"{expense.comment} By {expense.purchased_by} at {expense.purchased_date:%Y-%m-%d}"
+    )
     st.caption(f"Expense #{expense.rowid}")
     st.write(f"${expense.price_in_cents / 100 :.2f}")
 
 
+def debug_echo() -> contextlib.AbstractContextManager:
+    """st.echo the enclosed code only when the LEDGER_DEBUG environment variable is set,
+    as st.echo re-reads this file's source every rerun"""
+    return st.echo() if os.environ.get("LEDGER_DEBUG") else contextlib.nullcontext()
+
+
+def clear_expense_caches() -> None:
+    """Invalidate cached expense queries after the expenses table changes"""
+    ExpenseService.list_all_purchasers.clear()
+    ExpenseService.list_expense_labels.clear()
+    get_data.clear()
+    get_feed_page.clear()
+    build_spending_frames.clear()
+    build_spending_figure.clear()
+
+
 def do_create(connection: sqlite3.Connection, expense: BaseExpense) -> None:
     """Streamlit callback for creating a expense and showing confirmation"""
     st.warning("Creating your Expense")
     ExpenseService.create_expense(connection, expense)
+    clear_expense_caches()
     st.success(
         f"Successfully Created your Expense! Check the Read Expense Feed page to see it"
     )
@@ -45,18 +72,225 @@ def render_create(connection: sqlite3.Connection) -> None:
 
 
 def prep_df_for_display(df: pd.DataFrame) -> pd.DataFrame:
-    return df.divide(100).reset_index().melt("purchased_date")
+    """Convert a wide frame of cents per person into long dollars for plotting"""
+    dollars = pd.DataFrame(
+        df.to_numpy(dtype=np.float64) / 100, index=df.index, columns=df.columns
+    )
+    return dollars.stack().rename("value").reset_index()
+
 
+def narrow_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Narrow dtypes to cut memory moved through the groupby / rolling kernels.
+    Cent amounts and rowids all fit in int32"""
+    int_columns = [
+        column
+        for column in df.columns
+        if column == "rowid" or column.endswith("price_in_cents")
+    ]
+    df[int_columns] = df[int_columns].astype("int32")
+    df["purchased_by"] = df["purchased_by"].astype("category")
+    df["purchased_date"] = pd.to_datetime(df["purchased_date"])
+    return df
 
-@st.cache(hash_funcs={sqlite3.Connection: id}, suppress_st_warning=True)
+
+@st.cache_data(ttl=60, show_spinner=False)
 def get_data(
-    connection, start_date: date, end_date: date, selections: list[str]
+    _connection: sqlite3.Connection,
+    start_date: Optional[date],
+    end_date: Optional[date],
+    selections: Optional[list[str]],
+) -> pd.DataFrame:
+    df = ExpenseService.list_all_expenses_df(
+        _connection, start_date, end_date, selections
+    )
+    return narrow_dtypes(df)
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_feed_page(
+    _connection: sqlite3.Connection,
+    offset: int,
+    limit: int,
+    table_version: Tuple[int, int],
 ) -> pd.DataFrame:
-    expense_rows = ExpenseService.list_all_expenses(
-        connection, start_date, end_date, selections
+    """Keyed on `table_version` so a page never disagrees with the live page count"""
+    df = ExpenseService.list_expenses_page_df(_connection, offset, limit)
+    return narrow_dtypes(df)
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_spending_frames(
+    _connection: sqlite3.Connection,
+    start_date: date,
+    end_date: date,
+    selections: Tuple[str, ...],
+    table_version: Tuple[int, int],
+) -> Optional[Tuple[pd.DataFrame, ...]]:
+    """Pivot daily spending per person and derive the long-form frames each chart plots.
+    Cached across reruns and keyed on `table_version` so rows added or removed outside this app
+    miss the cache too. Cleared by `clear_expense_caches` after writes from this app.
+    Returns None when nobody selected spent anything in the date range"""
+    # Gap filled daily, running, and trailing window sums per person, all computed by SQLite
+    window_df = ExpenseService.list_daily_window_totals_df(
+        _connection, start_date, end_date, list(selections)
+    )
+    if window_df.empty:
+        return None
+    window_df = narrow_dtypes(window_df)
+    # Pivot each metric into columns of each purchased_by person
+    # fill_value keeps the pivot integer even if a person / day pair were ever missing
+    metrics_df = window_df.set_index(["purchased_date", "purchased_by"]).unstack(
+        "purchased_by", fill_value=0
+    )
+    pivot_df = metrics_df["price_in_cents"]
+
+    # All spending days
+    spend_df = prep_df_for_display(pivot_df)
+
+    # Cumulative spend over time for each person
+    cum_df = metrics_df["cum_price_in_cents"]
+    # Share of contributions over time (ignore All), one broadcast over the raw array
+    # Kept as a 0-1 ratio, the chart formats it as a percent
+    person_cum_df = cum_df[cum_df.columns.drop("All", errors="ignore")]
+    person_cum = person_cum_df.to_numpy(dtype=np.float64)
+    cum_totals = person_cum.sum(axis=1, keepdims=True)
+    cum_pct_df = pd.DataFrame(
+        np.divide(
+            person_cum,
+            cum_totals,
+            out=np.zeros_like(person_cum),
+            where=cum_totals > 0,
+        ),
+        index=person_cum_df.index,
+        columns=person_cum_df.columns,
+    )
+
+    cum_df = prep_df_for_display(cum_df)
+    cum_pct_df = cum_pct_df.reset_index().melt("purchased_date")
+
+    # Sum of each spender
+    totals = ExpenseService.list_purchaser_totals_df(
+        _connection, start_date, end_date, list(selections)
+    )
+
+    # 7 Day cumulative spending
+    rolling_df = prep_df_for_display(metrics_df["week_price_in_cents"])
+
+    # 30 Day daily maxes
+    maxes_df = prep_df_for_display(metrics_df["month_max_price_in_cents"])
+
+    # One long frame for the line charts, one subplot row per metric
+    lines_df = pd.concat(
+        [
+            cum_df.assign(metric="Cumulative Spending"),
+            rolling_df.assign(metric="Weekly Spending"),
+            maxes_df.assign(metric="Monthly Biggest Purchase"),
+        ],
+        ignore_index=True,
+    )
+    lines_df["metric"] = lines_df["metric"].astype("category")
+
+    return totals, spend_df, cum_pct_df, lines_df
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def build_spending_figure(
+    _spending_frames: Tuple[pd.DataFrame, ...],
+    start_date: date,
+    end_date: date,
+    selections: Tuple[str, ...],
+    table_version: Tuple[int, int],
+) -> go.Figure:
+    """Draw every spending chart as a row of one subplot figure.
+    Cached on the same key as `build_spending_frames`, which fully determines the frames,
+    so reruns skip both hashing the frames and rebuilding the figure. Cleared by `clear_expense_caches`"""
+    totals, spend_df, cum_pct_df, lines_df = _spending_frames
+    # Same color per person in every row
+    palette = px.colors.qualitative.Plotly
+    colors = {
+        purchased_by: palette[i % len(palette)]
+        for i, purchased_by in enumerate(totals["purchased_by"])
+    }
+    labels = {"purchased_by": "Purchased By", "purchased_date": "Purchased Date"}
+    over_time = dict(
+        x="purchased_date", y="value", color="purchased_by", color_discrete_map=colors
+    )
+    line_labels = {
+        "Cumulative Spending": "Total Dollars Spent To Date",
+        "Weekly Spending": "Dollars Spent Over 7 Days",
+        "Monthly Biggest Purchase": "Biggest Purchase Over 30 Days",
+    }
+    charts = [
+        (
+            "Total Spending Per Person",
+            px.bar(
+                totals,
+                x="value",
+                y="purchased_by",
+                color="purchased_by",
+                color_discrete_map=colors,
+                labels={**labels, "value": "Total Dollars Spent"},
+            ),
+        )
+    ]
+    # Shares need per person columns, selecting only "All" leaves none to draw
+    if not cum_pct_df.empty:
+        share_chart = px.area(
+            cum_pct_df, **over_time, labels={**labels, "value": "Share of Spending"}
+        )
+        # Shares are 0-1 ratios, shown as percents on the axis and in hovers
+        share_chart.update_yaxes(tickformat=".0%")
+        share_chart.update_traces(yhoverformat=".1%")
+        charts.append(("Percentage of Spending", share_chart))
+    charts += [
+        (
+            "Dollars Spent Per Day",
+            px.bar(
+                spend_df, **over_time, labels={**labels, "value": "Dollars spent per day"}
+            ),
+        ),
+        *(
+            (
+                metric,
+                px.line(
+                    lines_df[lines_df["metric"] == metric],
+                    **over_time,
+                    labels={**labels, "value": line_labels.get(metric, "Dollars")},
+                ),
+            )
+            for metric in lines_df["metric"].unique()
+        ),
+    ]
+    figure = make_subplots(
+        rows=len(charts),
+        cols=1,
+        subplot_titles=[title for title, _ in charts],
+        vertical_spacing=0.04,
     )
-    expenses = [Expense(**row) for row in expense_rows]
-    return pd.DataFrame([x.dict() for x in expenses])
+    # One legend entry per person, toggling their traces in every row
+    in_legend = set()
+    for row, (_, chart) in enumerate(charts, start=1):
+        for trace in chart.data:
+            trace.showlegend = trace.name not in in_legend
+            in_legend.add(trace.name)
+            figure.add_trace(trace, row=row, col=1)
+        # Subplot axes start bare, carry over each chart's titles (from `labels`) and tick formats
+        figure.update_xaxes(
+            title_text=chart.layout.xaxis.title.text,
+            tickformat=chart.layout.xaxis.tickformat,
+            row=row,
+            col=1,
+        )
+        figure.update_yaxes(
+            title_text=chart.layout.yaxis.title.text,
+            tickformat=chart.layout.yaxis.tickformat,
+            row=row,
+            col=1,
+        )
+    figure.update_layout(
+        height=350 * len(charts), barmode="relative", legend_title_text="Purchased By"
+    )
+    return figure
 
 
 def render_read(connection: sqlite3.Connection) -> None:
@@ -64,7 +298,8 @@ def render_read(connection: sqlite3.Connection) -> None:
     st.success("Reading Expense Feed")
 
     # render_create(connection)
-    purchasers = ExpenseService.list_all_purchasers(connection)
+    table_version = ExpenseService.get_table_version(connection)
+    purchasers = ExpenseService.list_all_purchasers(connection, table_version)
     selections = st.multiselect(
         "Show Spending For:", [*purchasers, "All"], default=purchasers
     )
@@ -72,114 +307,82 @@ def render_read(connection: sqlite3.Connection) -> None:
         "Start Date", value=date.today() - timedelta(days=30 * 6)
     )
     end_date = st.date_input("End Date", value=date.today())
-    with st.expander("Show Raw Data"), st.echo():
+    with st.expander("Show Raw Data"), debug_echo():
         raw_df = get_data(connection, start_date, end_date, selections)
         st.write(raw_df)
 
-    with st.expander("Data Cleaning"), st.echo():
-        # Take needed columns
-        df = raw_df[["purchased_date", "purchased_by", "price_in_cents"]]
-        # Pivot data into columns of each purchased_by person, summing any dupes for a given day
-        pivot_df = df.pivot_table(
-            index="purchased_date", columns="purchased_by", aggfunc="sum", fill_value=0
-        )
-        # Ignore multiindex that doesn't give much in this case
-        pivot_df.columns = pivot_df.columns.droplevel(0)
-        # Avoid doing summation with floats and money
-        if "All" in selections:
-            pivot_df["All"] = pivot_df.sum(axis=1)
-
-        # Fill in date gaps
-        min_date = pivot_df.index.min()
-        max_date = pivot_df.index.max()
-        all_dates = pd.date_range(min_date, max_date, freq="D", name="purchased_date")
-        pivot_df = pivot_df.reindex(all_dates, fill_value=0)
-
-        # All spending days
-        spend_df = prep_df_for_display(pivot_df)
-
-        # Cumulative spend over time for each person
-        cum_df = pivot_df.cumsum()
-        # Percent of contributions over time (ignore All)
-        cum_pct_df = (
-            cum_df[cum_df.columns.drop("All", errors="ignore")]
-            .divide(cum_df.sum(axis=1), axis=0)
-            .multiply(100)
+    if not selections:
+        # Nothing to chart, skip the spending queries and figure builds
+        st.warning("Select at least one person to see the charts")
+        render_expense_feed(connection, table_version)
+        return
+
+    with st.expander("Data Cleaning"), debug_echo():
+        # Pivot, gap fill, accumulate, and melt the daily spending for charting
+        spending_frames = build_spending_frames(
+            connection,
+            start_date,
+            end_date,
+            tuple(selections),
+            table_version,
         )
 
-        cum_df = prep_df_for_display(cum_df)
-        cum_pct_df = cum_pct_df.reset_index().melt("purchased_date")
+    if spending_frames is None:
+        st.warning("No spending found for these people between these dates")
+        render_expense_feed(connection, table_version)
+        return
 
-        # Sum of each spender
-        totals = pivot_df.sum()
-        totals.index.name = "purchased_by"
-        totals.name = "value"
-        totals = totals.div(100).reset_index()
+    st.header("Spending Per Person")
+    # One figure and one payload for every chart
+    spending_figure = build_spending_figure(
+        spending_frames, start_date, end_date, tuple(selections), table_version
+    )
+    st.plotly_chart(spending_figure, use_container_width=True)
 
-        # 7 Day cumulative spending
-        rolling_df = pivot_df.rolling(7, min_periods=1).sum()
-        rolling_df = prep_df_for_display(rolling_df)
+    render_expense_feed(connection, table_version)
 
-        # 30 Day daily maxes
-        maxes_df = pivot_df.rolling(30, min_periods=1).max()
-        maxes_df = prep_df_for_display(maxes_df)
 
-    st.header("Total Spending Per Person")
-    spending_per_person = px.bar(
-        totals,
-        x="value",
-        y="purchased_by",
-        color="purchased_by",
-        labels={"purchased_by": "Purchased By", "value": "Total Dollars Spent"},
+def render_expense_feed(
+    connection: sqlite3.Connection, table_version: Tuple[int, int]
+) -> None:
+    """Show expenses newest first as one table, one page at a time.
+    `table_version` is the caller's `ExpenseService.get_table_version` result, its row count sizes the pages"""
+    st.header("Expense Feed")
+    expense_count, _ = table_version
+    page_count = max(1, -(-expense_count // FEED_PAGE_SIZE))
+    page = st.number_input(
+        f"Page (of {page_count})",
+        min_value=1,
+        max_value=page_count,
+        value=1,
+        step=1,
+        key="feed_page",
     )
-    st.plotly_chart(spending_per_person, use_container_width=True)
-
-    st.header("Percentage of Spending")
-    spending_pct = px.area(
-        cum_pct_df, x="purchased_date", y="value", color="purchased_by"
+    # Only the visible page is fetched and shipped to the browser. SQLite still walks the date index
+    # past the `offset` earlier rows (sorting same-date ties by rowid), fine at this table's size
+    feed_df = get_feed_page(
+        connection, (page - 1) * FEED_PAGE_SIZE, FEED_PAGE_SIZE, table_version
     )
-    st.plotly_chart(spending_pct, use_container_width=True)
-
-    spending_per_day = px.bar(
-        spend_df,
-        x="purchased_date",
-        y="value",
-        color="purchased_by",
-        labels={"value": "Dollars spent per day"},
-        height=500,
+    display_df = feed_df.assign(price=feed_df["price_in_cents"] / 100)[
+        ["rowid", "purchased_date", "purchased_by", "price", "comment"]
+    ]
+    # One Arrow table instead of a subheader, caption, and write per expense
+    st.dataframe(
+        display_df,
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            "purchased_date": st.column_config.DateColumn("Purchased Date"),
+            "price": st.column_config.NumberColumn("Price", format="$%.2f"),
+        },
     )
-    st.plotly_chart(spending_per_day)
-
-    st.header("Cumulative Spending Per Person")
-
-    if selections:
-        st.header("Cumulative Spending To Date")
-        multi_line = lambda x: px.line(
-            x, x="purchased_date", y="value", color="purchased_by"
-        )
-        fig = multi_line(cum_df)
-        st.plotly_chart(fig, use_container_width=True)
-
-        rolling_chart = multi_line(rolling_df)
-        st.header("Weekly Spending Per Person")
-        st.plotly_chart(rolling_chart, use_container_width=True)
-
-        maxes_chart = multi_line(maxes_df)
-        st.header("Monthly Biggest Purchase Per Person")
-        st.plotly_chart(maxes_chart, use_container_width=True)
-    else:
-        st.warning("Select at least one person to see the charts")
-
-    expenses = ExpenseService.list_all_expenses(connection)
-    st.header("Expense Feed")
-    for expense in expenses:
-        render_expense(Expense(**expense))
 
 
 def do_update(connection: sqlite3.Connection, new_expense: Expense) -> None:
     """Streamlit callback for updating a expense and showing confirmation"""
     st.warning(f"Updating Expense #{new_expense.rowid}")
     ExpenseService.update_expense(connection, new_expense)
+    clear_expense_caches()
     st.success(
         f"Updated Expense #{new_expense.rowid}, go to the Read Expenses Feed to see it!"
     )
@@ -188,14 +391,19 @@ def do_update(connection: sqlite3.Connection, new_expense: Expense) -> None:
 def render_update(connection: sqlite3.Connection) -> None:
     """Show the form for updating an existing Expense"""
     st.success("Reading Expenses")
-    expense_rows = ExpenseService.list_all_expenses(connection)
-    expense_map = {row["rowid"]: Expense(**row) for row in expense_rows}
+    labels = dict(
+        ExpenseService.list_expense_labels(
+            connection, ExpenseService.get_table_version(connection)
+        )
+    )
     expense_id = st.selectbox(
         "Which Expense to Update?",
-        expense_map.keys(),
-        format_func=lambda x: f"{expense_map[x].rowid} {expense_map[x].comment} - by {expense_map[x].purchased_by} on {expense_map[x].purchased_date}",
+        list(labels),
+        format_func=labels.get,
+        key="update_expense_id",
     )
-    expense_to_update = expense_map[expense_id]
+    # Only the selected row needs a validated model
+    expense_to_update = ExpenseService.get_expense(connection, expense_id)
     with st.form("update_form"):
         st.write("Update Purchase Info")
         price = st.number_input(
@@ -217,7 +425,7 @@ def render_update(connection: sqlite3.Connection) -> None:
 
         submitted = st.form_submit_button(
             "Submit",
-            help="This will change the body of the expense, the username, or both. It also updates the updated at time.",
+            help="This will change the price of the expense, the purchase date, or both.",
         )
         if submitted:
             new_expense = Expense(
@@ -234,16 +442,26 @@ def do_delete(connection: sqlite3.Connection, expense_to_delete: Expense) -> Non
     """Streamlit callback for deleting a expense and showing confirmation"""
     st.warning(f"Deleting Expense #{expense_to_delete.rowid}")
     ExpenseService.delete_expense(connection, expense_to_delete)
+    clear_expense_caches()
     st.success(f"Deleted Expense #{expense_to_delete.rowid}")
 
 
 def render_delete(connection: sqlite3.Connection) -> None:
     """Show the form for deleting an existing Expense"""
     st.success("Reading Expenses")
-    expense_rows = ExpenseService.list_all_expenses(connection)
-    expense_map = {row["rowid"]: Expense(**row) for row in expense_rows}
-    expense_id = st.selectbox("Which Expense to Delete?", expense_map.keys())
-    expense_to_delete = expense_map[expense_id]
+    labels = dict(
+        ExpenseService.list_expense_labels(
+            connection, ExpenseService.get_table_version(connection)
+        )
+    )
+    expense_id = st.selectbox(
+        "Which Expense to Delete?",
+        list(labels),
+        format_func=labels.get,
+        key="delete_expense_id",
+    )
+    # Only the selected row needs a validated model
+    expense_to_delete = ExpenseService.get_expense(connection, expense_id)
 
     render_expense(expense_to_delete)
 